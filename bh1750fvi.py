@@ -24,6 +24,7 @@ It is possible to detect wide scale at High resolution. (1 - 65535 lx).
 """
 
 import i2c
+import timers
 
 # Define some constants from the datasheet
 
@@ -63,6 +64,9 @@ SENSITIVITY_DEFAULT = 1.00
 ACCURACY_MIN = 0.96
 ACCURACY_MAX = 1.44
 ACCURACY_DEFAULT = 1.2 
+
+# Valid resolution indexes
+_VALID_RES = frozenset((1, 2, 3, 4, 5, 6))
     
 class BH1750FVI(i2c.I2C):
     """
@@ -94,27 +98,32 @@ class BH1750FVI(i2c.I2C):
     """ Implement BH1750 communication. """
     
     # list of measurement mode
-    list_meas_mode = [
+    list_meas_mode = (
         ONE_TIME_HIGH_RES_MODE_1,
         ONE_TIME_HIGH_RES_MODE_2,
         ONE_TIME_LOW_RES_MODE,
         CONTINUOUS_HIGH_RES_MODE_1,
         CONTINUOUS_HIGH_RES_MODE_2,
         CONTINUOUS_LOW_RES_MODE
-    ]
+    )
 
     def __init__(self, drvname, addr=0x23, clk=400000):
         
-        if (addr != 0x23 and addr != 0x5c):
+        if (addr not in (0x23, 0x5c)):
             raise ValueError
 
         i2c.I2C.__init__(self,drvname,addr,clk)
-        try:
-            self.start()
-        except PeripheralError as e:
-            print(e)
-            
-        self.set_mode(POWER_DOWN)
+        self.start()
+
+        # seed calibration values so the setters can refresh the lx scale
+        self.accuracy = ACCURACY_DEFAULT
+        self.sensitivity = SENSITIVITY_DEFAULT
+        self._res_scale = 1.0
+        # continuous measurement mode currently running on the sensor, if any
+        self._last_mode = None
+
+        # the sensor starts in Power Down, no need to write it
+        self.mode = POWER_DOWN
         self.set_sensitivity()
         self.set_accuracy()
         self.set_resolution()
@@ -127,6 +136,7 @@ class BH1750FVI(i2c.I2C):
     ##
     def set_mode(self, mode):
         self.mode = mode
+        self._last_mode = None
         self.write_bytes(self.mode)
 
     ##
@@ -147,7 +157,10 @@ class BH1750FVI(i2c.I2C):
 
         Sensitivity scale is 0.45-3.68, typical value is 1.
 
-        Set the sensor sensitivity value.
+        Set the sensor sensitivity value. The sensitivity is programmed through
+        the MTreg register as ``sensitivity * 69`` rounded to the nearest step and
+        clamped to 31-254, so the stored sensitivity is ``mtreg / 69``
+        (e.g. 1.5 is stored as 1.5072, 0.45 as 0.4493 and 3.68 as 3.6812).
 
         """
 
@@ -155,31 +168,28 @@ class BH1750FVI(i2c.I2C):
         valueMTreg = sensitivity * MTREG_DEFAULT
 
         # safety check, make sure valueMTreg never exceeds the limits
-        if (valueMTreg < MTREG_MIN):
-            self.mtreg   = MTREG_MIN
-            self.sensitivity = SENSITIVITY_MIN
-        elif (valueMTreg > MTREG_MAX):
-            self.mtreg   = MTREG_MAX
-            self.sensitivity = SENSITIVITY_MAX
-        else:
-            self.mtreg = valueMTreg
-            self.sensitivity = sensitivity
-
-        meas_TimeHighBit = self.mtreg
-        meas_TimeLowBit  = self.mtreg
-
-        # high bit manipulation
-        meas_TimeHighBit >>= 5
-        meas_TimeHighBit |= MEASUREMENT_TIME_H # 0,1,0,0,0,MT[7-bit,6-bit,5-bit]
-       
-        # low bit manipulation
-        meas_TimeLowBit <<= 3
-        meas_TimeLowBit >>= 3
-        meas_TimeLowBit |= MEASUREMENT_TIME_L # 0,1,1,MT[4-bit,3-bit,2-bit,1-bit,0-bit]
-        
-        # update sensor Measurment Timer register
+        valueMTreg = MTREG_MIN if valueMTreg < MTREG_MIN else \
+            (MTREG_MAX if valueMTreg > MTREG_MAX else valueMTreg)
+        self.mtreg = int(valueMTreg + 0.5)
+        # keep sensitivity consistent with the MTreg actually programmed
+        self.sensitivity = self.mtreg / MTREG_DEFAULT
+
+        # 0,1,0,0,0,MT[7-bit,6-bit,5-bit] and 0,1,1,MT[4-bit,3-bit,2-bit,1-bit,0-bit]
+        meas_TimeHighBit = (self.mtreg >> 5) | MEASUREMENT_TIME_H
+        meas_TimeLowBit  = (self.mtreg & 0x1F) | MEASUREMENT_TIME_L
+
+        # update sensor Measurment Timer register,
+        # each opcode is a separate instruction on the bus (see datasheet)
         self.write_bytes(meas_TimeHighBit)
         self.write_bytes(meas_TimeLowBit)
+        # a running continuous measurement has to be restarted
+        self._last_mode = None
+
+        # measurement times in ms scale with the sensitivity
+        self._wait_high_ms = int(120 * self.sensitivity)
+        self._wait_low_ms = int(16 * self.sensitivity)
+
+        self._recompute_scale()
         
     def get_sensitivity(self):
         """
@@ -196,10 +206,7 @@ class BH1750FVI(i2c.I2C):
     ##
     def get_result(self):
         data = self.read(n=2)
-        high_bytes = data[0]
-        low_bytes = data[1]
-        res = low_bytes + (256 * high_bytes)
-        return res
+        return (data[0] << 8) | data[1]
 
     ##
     ## @brief      Wait the delay to get result.
@@ -210,12 +217,23 @@ class BH1750FVI(i2c.I2C):
     def wait_for_result(self, mode):
         # if measurement mode is low
         if (mode & 0x03) == 0x03:
-            basetime = 16
+            wait_time = self._wait_low_ms
         else:
-            basetime = 120
-        
-        wait_time = int(basetime * self.sensitivity)
-        sleep(wait_time)
+            wait_time = self._wait_high_ms
+
+        self._sleep_until(timers.now() + wait_time)
+
+    ##
+    ## @brief      Sleep until the deadline, sleeping again if woken up early.
+    ##
+    ## @param      deadline     is the time in ms, as given by timers.now().
+    ## @return     nothing
+    ##
+    def _sleep_until(self, deadline):
+        remaining = deadline - timers.now()
+        while remaining > 0:
+            sleep(remaining)
+            remaining = deadline - timers.now()
 
     ##
     ## @brief      Perform complete measurement using command specified by parameter mode.
@@ -225,10 +243,38 @@ class BH1750FVI(i2c.I2C):
     ## @return     measurement value in lx.
     ##
     def do_measurement(self, mode):
-        self.reset()
-        self.write_bytes(mode)
-        self.wait_for_result(mode)
-        return self.get_result()
+        if mode == self._last_mode:
+            # in continuous mode the sensor keeps refreshing the data register,
+            # wait until a new sample is available since the last read
+            self._sleep_until(self._next_sample)
+        else:
+            # power on, reset and start the measurement back to back,
+            # the sensor takes each opcode as a separate instruction
+            wb = self.write_bytes
+            self.mode = RESET
+            self._last_mode = None
+            wb(POWER_ON)
+            wb(RESET)
+            wb(mode)
+            self.wait_for_result(mode)
+        data = self.read(n=2)
+        # if measurement mode is continuous, remember it only once a sample
+        # has been read, next sample is ready after one more measurement time
+        if (mode & 0xF0) == 0x10:
+            if (mode & 0x03) == 0x03:
+                self._next_sample = timers.now() + self._wait_low_ms
+            else:
+                self._next_sample = timers.now() + self._wait_high_ms
+            self._last_mode = mode
+        return (data[0] << 8) | data[1]
+
+    ##
+    ## @brief      Update the factor converting raw counts to lx.
+    ##
+    ## @return     nothing
+    ##
+    def _recompute_scale(self):
+        self._lx_scale = self._res_scale / (self.accuracy * self.sensitivity)
 
     def set_accuracy(self, accuracy=1.2):
         """
@@ -249,6 +295,8 @@ class BH1750FVI(i2c.I2C):
         else:
             self.accuracy = accuracy
 
+        self._recompute_scale()
+
     def get_accuracy(self):
         """
     .. method:: get_accuracy() 
@@ -280,10 +328,15 @@ class BH1750FVI(i2c.I2C):
         Set the sensor resolution value.
 
         """
-        if (res not in [1, 2, 3, 4, 5, 6]):
+        if (res not in _VALID_RES):
             raise ValueError
 
         self.resolution = self.list_meas_mode[res-1]
+        self._res_index = res
+
+        # 0.5 lx resolution modes count in half lx
+        self._res_scale = 0.5 if res in (2, 5) else 1.0
+        self._recompute_scale()
     
     def get_resolution(self):
         """
@@ -291,7 +344,7 @@ class BH1750FVI(i2c.I2C):
 
         Return the resolution set.
         """
-        return self.list_meas_mode.index(self.resolution) + 1
+        return self._res_index
 
     def get_value(self):
         """
@@ -300,12 +353,4 @@ class BH1750FVI(i2c.I2C):
         Return the ambient light value in lx.
         
         """
-        raw_value = self.do_measurement(self.resolution)
-
-        light = raw_value / (self.accuracy * self.sensitivity)
-
-        # if resolution is 0.5 lx
-        if (self.get_resolution() in [2, 5]):
-            light *= 0.5
-        
-        return light
\ No newline at end of file
+        return self.do_measurement(self.resolution) * self._lx_scale
\ No newline at end of file